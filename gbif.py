@@ -4,30 +4,490 @@
 import os
 import pandas as pd
 import concurrent.futures
+import atexit
+import collections
+import itertools
+import random
+import threading
 import time
-import json
+import orjson
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
 from datetime import datetime
+from json_trans import is_converted_field
 
 # 全局参数
 MAX_RECORDS_PER_SPECIES = 1e7  # 每个物种最多下载的记录数
-REQUEST_DELAY = 0.3            # 请求之间的延迟秒数
-PARALLEL_DOWNLOADS = 2         # 并行下载线程数
+PARALLEL_DOWNLOADS = 16        # 并行处理的物种线程数（实际并发请求数由Controller控制）
+INITIAL_CONCURRENCY = 2        # 初始并发请求数
+MIN_CONCURRENCY = 1            # 并发请求数下限
+MAX_CONCURRENCY = 16           # 并发请求数上限
+TARGET_LATENCY = 2.0           # 目标请求延迟秒数，超过则降低并发
+MAX_REQUESTS_PER_MINUTE = 600  # 滑动窗口内每分钟最多请求数
+PAGE_PREFETCH = 4              # 每个物种同时预取的页数
+MAX_IN_FLIGHT = 2 * PARALLEL_DOWNLOADS  # 同时提交到线程池的物种任务数上限
+BATCH_SIZE = 10                # 记录数少于一页的物种，每次请求最多合并的物种数
+MAX_OFFSET = 100000            # GBIF搜索API的分页上限，超过后按年份/月份切分查询
+FIRST_YEAR = 1600              # 按年份切分查询时的起始年份
 RETRY_COUNT = 3               # 出错时最大重试次数
-RETRY_DELAY = 5               # 重试之间的等待秒数
+RETRY_DELAY = 5               # 首次重试前的等待秒数，之后指数增加（上限60秒）
 DEBUG_MODE = True             # 是否输出详细信息
+TRIM_FIELDS = True            # 是否只保存json_trans.py转换时用到的字段，减小文件体积和后续解析时间
+PRETTY_JSON = False           # 是否以缩进格式保存JSON（便于人工查看，文件体积会大2-3倍）
+
+# 裁剪记录时额外保留的字段（去重和物种识别用）
+KEEP_FIELDS = {'gbifID', 'taxonKey', 'speciesKey', 'acceptedTaxonKey'}
+
+# GBIF下载API参数：记录数超过阈值的物种改为异步下载DwC-A压缩包，需要GBIF账号
+GBIF_USER = os.environ.get('GBIF_USER')
+GBIF_PWD = os.environ.get('GBIF_PWD')
+GBIF_EMAIL = os.environ.get('GBIF_EMAIL')
+DOWNLOAD_API_THRESHOLD = 100000  # 超过该记录数时使用下载API
+DOWNLOAD_POLL_INTERVAL = 30      # 查询下载任务状态的间隔秒数
+DOWNLOAD_MAX_WAIT = 6 * 3600     # 等待下载任务完成的最长秒数，超时后改用分页查询
+
+# HTTP响应缓存：中断后重新运行时，相同参数的请求直接从磁盘读取。
+# 缓存没有大小上限，保存的是未裁剪的完整响应体：每页300条记录约0.8 MB，
+# 缓存分页结果时大物种会产生数GB的缓存文件，因此默认只缓存物种匹配结果；
+# 记录总数与分页结果一同缓存或一同实时查询，避免按过期的总数分页而漏掉新增记录
+CACHE_PATH = 'gbif_cache.sqlite'
+CACHE_EXPIRE = 7 * 86400       # 缓存有效期秒数
+CACHE_PAGES = False            # 是否同时缓存分页结果（占用大量磁盘空间）
+
+# 不读写缓存的请求附加的请求头；requests-cache 的 expire_after=DO_NOT_CACHE 只跳过读取，响应仍会写入缓存
+NO_STORE = {'Cache-Control': 'no-store'}
+
+# GBIF搜索API URL
+SEARCH_URL = "https://api.gbif.org/v1/occurrence/search"
 
 # 创建目录保存下载的数据
 os.makedirs('occurrences', exist_ok=True)
+os.makedirs('dwca', exist_ok=True)
+
+# 全局共享的HTTP会话，复用连接（keep-alive）避免每页重新进行TCP/TLS握手；
+# GET响应缓存到磁盘，只缓存成功的响应
+SESSION = requests_cache.CachedSession(
+    CACHE_PATH,
+    expire_after=CACHE_EXPIRE,
+    cache_control=True,
+    allowable_methods=('GET',)
+)
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=MAX_CONCURRENCY,
+    pool_maxsize=MAX_CONCURRENCY * 2,
+    max_retries=0  # 重试由fetch_json自行处理
+))
+
+# 全局持久线程池：物种任务和分页预取任务分开，避免物种任务等待分页结果时占满线程导致死锁
+POOL = concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_DOWNLOADS, thread_name_prefix='gbif')
+PAGE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENCY * 2, thread_name_prefix='gbif-page')
+atexit.register(POOL.shutdown)
+atexit.register(PAGE_POOL.shutdown)
+
+def _parse_retry_after(value):
+    """解析Retry-After响应头（秒数），无法解析时返回None"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+class Controller:
+    """AIMD自适应并发控制器：成功时加性增加并发，遇到429/5xx时乘性减少，并按60秒滑动窗口限制请求速率"""
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY,
+                 target_latency=TARGET_LATENCY, max_rpm=MAX_REQUESTS_PER_MINUTE):
+        self.current_concurrency = float(initial)
+        self.min_concurrency = minimum
+        self.max_concurrency = maximum
+        self.target_latency = target_latency
+        self.max_rpm = max_rpm
+        self._active = 0
+        self._paused_until = 0.0
+        self._timestamps = collections.deque()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """等待直到正在进行的请求数低于当前并发上限"""
+        with self._cond:
+            while self._active >= int(self.current_concurrency):
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def wait_if_throttled(self):
+        """阻塞直到服务器要求的暂停结束，且滑动窗口内最早的请求移出60秒窗口"""
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while self._timestamps and now - self._timestamps[0] >= 60:
+                    self._timestamps.popleft()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                elif len(self._timestamps) >= self.max_rpm:
+                    delay = 60 - (now - self._timestamps[0])
+                else:
+                    self._timestamps.append(now)
+                    return
+            time.sleep(delay)
+
+    def on_success(self, latency):
+        with self._cond:
+            if latency <= self.target_latency:
+                self.current_concurrency = min(self.max_concurrency, self.current_concurrency + 0.5)
+            else:
+                self.current_concurrency = max(self.min_concurrency, self.current_concurrency * 0.5)
+            self._cond.notify_all()
+
+    def on_error(self, status=None):
+        with self._cond:
+            self.current_concurrency = max(self.min_concurrency, self.current_concurrency * 0.5)
+        if DEBUG_MODE:
+            print(f"  请求失败 (状态 {status})，并发降至 {int(self.current_concurrency)}")
+
+    def on_response(self, response, latency):
+        """根据响应状态码和限流响应头调整并发"""
+        retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        if retry_after is not None and (response.status_code == 429 or remaining == '0'):
+            with self._cond:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        
+        if response.status_code == 429 or response.status_code >= 500:
+            self.on_error(response.status_code)
+        elif response.ok:
+            self.on_success(latency)
+
+CONTROLLER = Controller()
+
+def gbif_request(method, url, **kwargs):
+    """经过Controller限流和并发控制的HTTP请求"""
+    CONTROLLER.wait_if_throttled()
+    CONTROLLER.acquire()
+    try:
+        start = time.monotonic()
+        response = SESSION.request(method, url, **kwargs)
+        latency = time.monotonic() - start
+    except requests.exceptions.RequestException:
+        CONTROLLER.on_error()
+        raise
+    finally:
+        CONTROLLER.release()
+    CONTROLLER.on_response(response, latency)
+    return response
+
+def gbif_get(url, **kwargs):
+    return gbif_request('GET', url, **kwargs)
+
+class JsonArrayWriter:
+    """将记录逐页追加写入磁盘上的JSON数组，不在内存中累积全部结果
+
+    先写入临时文件，正常结束且有记录时才重命名为正式文件，中途出错则删除，
+    避免留下被"已下载"逻辑跳过的不完整文件。按gbifID去重，切片查询或分页
+    过程中数据变动导致的重复记录只写入一次。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.part'
+        self.count = 0
+        self._seen_ids = set()
+        # 默认输出紧凑格式，文件只供程序读取
+        self._option = orjson.OPT_INDENT_2 if PRETTY_JSON else 0
+        self._separator = b',\n' if PRETTY_JSON else b','
+        self._f = open(self.tmp_path, 'wb', buffering=1 << 20)
+        self._f.write(b'[')
+
+    def write(self, records):
+        for record in records:
+            gbif_id = record.get('gbifID')
+            if gbif_id is not None:
+                if gbif_id in self._seen_ids:
+                    continue
+                self._seen_ids.add(gbif_id)
+            if self.count:
+                self._f.write(self._separator)
+            self._f.write(orjson.dumps(record, option=self._option))
+            self.count += 1
 
-def download_species(species_name, index=None, total=None):
-    """下载单一物种的分布数据"""
-    # 将物种名转换为文件名
-    species_filename = species_name.replace(' ', '_') + '.json'
-    species_path = os.path.join('occurrences', species_filename)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._f.write(b']')
+        self._f.close()
+        if exc_type is None and self.count:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+        return False
+
+def fetch_json(species_name, base_url, params, cache=True):
+    """发送GET请求并解析JSON结果，出错时重试；达到最大重试次数返回None；cache为False时不读写缓存"""
+    headers = {'Accept-Encoding': 'gzip'}
+    if not cache:
+        headers.update(NO_STORE)
+    where = f" (offset {params['offset']})" if 'offset' in params else ''
+    retry_count = 0
+    while retry_count < RETRY_COUNT:
+        try:
+            # 请求速率与并发由CONTROLLER根据延迟和429自适应调整
+            response = gbif_get(base_url, params=params, timeout=(5, 60), headers=headers)
+            response.raise_for_status()  # 如有错误则引发异常
+            # 直接解码原始字节，省去先转为str再由标准库json解析的开销
+            return orjson.loads(response.content)
+            
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            response = getattr(e, 'response', None)
+            status = response.status_code if response is not None else None
+            # 除429外的4xx错误为请求本身有误，重试无意义
+            if status is not None and 400 <= status < 500 and status != 429:
+                print(f"  {species_name} 请求出错: {e}，跳过该请求{where}")
+                return None
+            
+            # 指数退避并加入随机抖动，避免各线程同时重试；服务器给出Retry-After时以其为准
+            delay = min(60, RETRY_DELAY * 2 ** retry_count) * random.uniform(0.5, 1.5)
+            if status in (429, 503):
+                retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+                if retry_after is not None:
+                    delay = retry_after
+            
+            retry_count += 1
+            print(f"  {species_name} 请求出错 ({retry_count}/{RETRY_COUNT}): {e}. {round(delay, 1)}秒后重试...")
+            time.sleep(delay)  # 出错时等待
+    
+    print(f"  {species_name}: 达到最大重试次数，跳过该请求{where}")
+    return None
+
+def match_species_key(species_name):
+    """通过 /v1/species/match 将物种名解析为GBIF物种key，无法精确匹配到物种时返回None"""
+    data = fetch_json(species_name, "https://api.gbif.org/v1/species/match", {'name': species_name})
+    # 仅匹配到更高分类等级时不能使用，否则会下载整个属的数据
+    if not data or data.get('matchType') in (None, 'NONE', 'HIGHERRANK'):
+        return None
+    return data.get('speciesKey', data.get('usageKey'))
+
+def download_species_archive(species_name, taxon_key, archive_path):
+    """通过GBIF下载API获取物种的全部记录（DwC-A压缩包），成功返回True"""
+    print(f"  {species_name}: 记录数较多，使用GBIF下载API")
+    # 下载条件与分页查询参数保持一致
+    query = {
+        'creator': GBIF_USER,
+        'notificationAddresses': [GBIF_EMAIL] if GBIF_EMAIL else [],
+        'sendNotification': False,
+        'format': 'DWCA',
+        'predicate': {
+            'type': 'and',
+            'predicates': [
+                {'type': 'equals', 'key': 'TAXON_KEY', 'value': str(taxon_key)},
+                {'type': 'equals', 'key': 'OCCURRENCE_STATUS', 'value': 'PRESENT'},
+                {'type': 'equals', 'key': 'HAS_COORDINATE', 'value': 'true'},
+                {'type': 'equals', 'key': 'HAS_GEOSPATIAL_ISSUE', 'value': 'false'}
+            ]
+        }
+    }
+    
+    try:
+        response = gbif_request('POST', "https://api.gbif.org/v1/occurrence/download/request",
+                                data=orjson.dumps(query), auth=(GBIF_USER, GBIF_PWD), timeout=(5, 60),
+                                headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+        download_key = response.text.strip()
+        if DEBUG_MODE:
+            print(f"  {species_name}: 下载任务 {download_key} 已创建")
+        
+        # 轮询任务状态直到打包完成；超时、连续查询失败或任务进入其他状态时放弃，改用分页查询
+        status_url = f"https://api.gbif.org/v1/occurrence/download/{download_key}"
+        deadline = time.monotonic() + DOWNLOAD_MAX_WAIT
+        failures = 0
+        while True:
+            if time.monotonic() >= deadline:
+                print(f"  {species_name}: 下载任务 {download_key} 超过 {DOWNLOAD_MAX_WAIT} 秒未完成")
+                return False
+            time.sleep(DOWNLOAD_POLL_INTERVAL)
+            # 任务状态会变化，不使用缓存
+            info = fetch_json(species_name, status_url, {}, cache=False)
+            if info is None:
+                failures += 1
+                if failures >= RETRY_COUNT:
+                    print(f"  {species_name}: 无法查询下载任务 {download_key} 的状态")
+                    return False
+                continue
+            failures = 0
+            status = info.get('status')
+            if status == 'SUCCEEDED':
+                break
+            if status not in ('PREPARING', 'RUNNING'):
+                print(f"  {species_name}: 下载任务 {download_key} 状态为 {status}")
+                return False
+        
+        # 流式写入磁盘，压缩包可能很大；长时间传输不经过Controller以免影响并发调整
+        tmp_path = archive_path + '.part'
+        with SESSION.get(info['downloadLink'], stream=True, timeout=(5, 300),
+                         headers=NO_STORE) as response:
+            response.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        os.replace(tmp_path, archive_path)
+        return True
+        
+    except requests.exceptions.RequestException as e:
+        print(f"  {species_name}: 使用下载API出错: {e}")
+        return False
+
+def trim_record(record):
+    """只保留转换为Excel时用到的字段及KEEP_FIELDS"""
+    return {key: value for key, value in record.items() if key in KEEP_FIELDS or is_converted_field(key)}
+
+def describe_slice(params):
+    """返回切片查询的说明文字，用于进度输出"""
+    return ''.join(f" [{key}={params[key]}]" for key in ('year', 'month') if key in params)
+
+def split_query(params):
+    """将查询二分为两个不重叠的切片：先按年份，单一年份再按月份；无法再切分时返回None"""
+    if 'month' in params:
+        return None
+    if 'year' not in params:
+        lo, hi = FIRST_YEAR, datetime.now().year
+    else:
+        lo, hi = (int(y) for y in params['year'].split(','))
+    if lo == hi:
+        return [dict(params, month='1,6'), dict(params, month='7,12')]
+    mid = (lo + hi) // 2
+    return [dict(params, year=f'{lo},{mid}'), dict(params, year=f'{mid + 1},{hi}')]
+
+def probe_count(species_name, base_url, params):
+    """用limit=0的请求只查询记录总数，不获取记录；请求失败返回None"""
+    # 分页范围由总数决定，总数须与分页结果来自同一来源
+    data = fetch_json(species_name, base_url, dict(params, limit=0, offset=0), cache=CACHE_PAGES)
+    return data.get('count', 0) if data is not None else None
+
+def download_pages(species_name, base_url, params, writer, total_records):
+    """分页下载一个查询的结果并写入writer；offset不超过GBIF的分页上限"""
+    label = species_name + describe_slice(params)
+    limit = params['limit']
+    fetched = 0
+    page_count = 0
+    
+    def submit(offset):
+        # 最后一页缩小limit，使offset+limit不超过分页上限
+        page_params = dict(params, offset=offset, limit=min(limit, MAX_OFFSET - offset))
+        return PAGE_POOL.submit(fetch_json, species_name, base_url, page_params, cache=CACHE_PAGES)
+    
+    # 总数已知，各页offset可提前计算并并行预取以隐藏网络延迟；记录数不超过一页时只需一次请求
+    end_offset = int(min(total_records, MAX_OFFSET))
+    offsets = iter(range(0, end_offset, limit))
+    pending = collections.deque(submit(offset) for offset in itertools.islice(offsets, PAGE_PREFETCH))
+    try:
+        # 按offset顺序处理各页，每处理一页补充一个预取任务
+        while pending:
+            data = pending.popleft().result()
+            for offset in itertools.islice(offsets, 1):
+                pending.append(submit(offset))
+            page_count += 1
+            if data is None:
+                continue
+            
+            results = data.get('results') or []
+            if not results:
+                if DEBUG_MODE:
+                    print(f"  {label}: 无结果，结束查询")
+                break
+            
+            # 每页结果直接写入磁盘
+            writer.write(map(trim_record, results) if TRIM_FIELDS else results)
+            fetched += len(results)
+            
+            # 显示简洁进度信息
+            progress_interval = 5 if total_records > 10000 else 2
+            if page_count % progress_interval == 0 or len(results) < limit:
+                percentage = round((fetched / total_records * 100), 2) if total_records > 0 else 0
+                print(f"  {label}: 已获取 {fetched}/{total_records} 条记录 ({percentage}%)")
+            
+            # 检查是否已获取所有结果或达到上限
+            if len(results) < limit or writer.count >= MAX_RECORDS_PER_SPECIES or fetched >= end_offset:
+                if DEBUG_MODE:
+                    print(f"  {label}: 已达到结束条件，获取完毕")
+                break
+    finally:
+        # 提前结束或出错时取消尚未开始的预取任务
+        for future in pending:
+            future.cancel()
+
+def download_query(species_name, base_url, params, writer, total_records=None):
+    """下载一个查询的全部结果；记录数超过分页上限时切分为更小的查询分别下载"""
+    if writer.count >= MAX_RECORDS_PER_SPECIES:
+        return
+    
+    # 先查询该查询的总记录数
+    if total_records is None:
+        total_records = probe_count(species_name, base_url, params)
+    if not total_records:
+        return
+    
+    if total_records > MAX_OFFSET:
+        slices = split_query(params)
+        if slices is not None:
+            label = species_name + describe_slice(params)
+            if DEBUG_MODE:
+                print(f"  {label}: {total_records} 条记录超过分页上限，切分查询")
+            
+            # 缺少年份/月份或早于FIRST_YEAR的记录不属于任何切片，先查询各切片记录数以报告缺失的数量
+            counts = [probe_count(species_name, base_url, slice_params) for slice_params in slices]
+            missing = total_records - sum(count or 0 for count in counts)
+            if missing > 0 and None not in counts:
+                reason = '缺少月份' if 'year' in params else f'缺少年份或早于{FIRST_YEAR}年'
+                hint = '' if GBIF_USER and GBIF_PWD else '，配置GBIF账号后可通过下载API获取全部记录'
+                print(f"  警告: {label}: {missing} 条记录{reason}，切分查询无法获取{hint}")
+            for slice_params, count in zip(slices, counts):
+                download_query(species_name, base_url, slice_params, writer, count)
+            return
+        print(f"  {species_name}{describe_slice(params)}: 无法继续切分，仅获取前 {MAX_OFFSET} 条记录")
+    
+    download_pages(species_name, base_url, params, writer, total_records)
+
+def species_paths(species_name):
+    """返回物种JSON文件和DwC-A压缩包的保存路径"""
+    filename = species_name.replace(' ', '_')
+    return os.path.join('occurrences', filename + '.json'), os.path.join('dwca', filename + '.zip')
+
+def is_downloaded(species_name):
+    return any(os.path.exists(path) for path in species_paths(species_name))
+
+def probe_species(species_name):
+    """解析物种key并查询总记录数，返回 (查询参数, 物种key, 总记录数)；查询失败时总记录数为None"""
+    # 参数设置，与GBIF网站保持一致
+    params = {
+        'limit': 300,  # 每页结果数量
+        'offset': 0,
+        'status': 'ACCEPTED',          # 仅接受有效的分类单元名称
+        'occurrenceStatus': 'PRESENT', # 仅包括存在记录
+        'hasCoordinate': 'true',       # 仅包括有坐标的记录
+        'hasGeospatialIssue': 'false', # 排除有地理空间问题的记录
+        'advanced': 'true'             # 启用高级查询模式，与网站一致
+    }
+    
+    # 优先使用物种key查询（服务端按索引查找，比按学名匹配快），无法匹配时按学名查询
+    taxon_key = match_species_key(species_name)
+    if taxon_key is not None:
+        params['taxonKey'] = taxon_key
+    else:
+        params['scientificName'] = species_name
+    
+    # 用limit=0的请求查询总数，据此选择下载方式
+    return params, taxon_key, probe_count(species_name, SEARCH_URL, params)
+
+def download_species(species_name, index=None, total=None, probe=None):
+    """下载单一物种的分布数据，probe为probe_species已查询的结果"""
+    species_path, archive_path = species_paths(species_name)
     
     # 如果已下载，跳过
-    if os.path.exists(species_path):
+    if os.path.exists(species_path) or os.path.exists(archive_path):
         if index is not None and total is not None:
             print(f"跳过物种 {index}/{total}: {species_name} (已下载)")
         return 0
@@ -36,89 +496,32 @@ def download_species(species_name, index=None, total=None):
         print(f"处理物种 {index}/{total}: {species_name}")
     
     try:
-        # GBIF API URL，设置参数与网站格式一致
-        base_url = "https://api.gbif.org/v1/occurrence/search"
-        
-        # 参数设置，与GBIF网站保持一致
-        params = {
-            'scientificName': species_name,
-            'limit': 300,  # 每页结果数量
-            'offset': 0,
-            'status': 'ACCEPTED',          # 仅接受有效的分类单元名称
-            'occurrenceStatus': 'PRESENT', # 仅包括存在记录
-            'hasCoordinate': 'true',       # 仅包括有坐标的记录
-            'hasGeospatialIssue': 'false', # 排除有地理空间问题的记录
-            'advanced': 'true'             # 启用高级查询模式，与网站一致
-        }
+        params, taxon_key, total_records = probe or probe_species(species_name)
+        if total_records is None:
+            print(f"  警告: {species_name} 没有获取到任何记录")
+            return 0
+        if DEBUG_MODE:
+            print(f"  {species_name}: 总记录数 {total_records}")
+        if total_records == 0:
+            print(f"  警告: {species_name} 没有获取到任何记录")
+            return 0
         
-        all_results = []
-        record_count = 0
-        page_count = 0
-        total_records = None
+        # 配置了GBIF账号时，记录数很多的物种改用下载API，避免数万次分页请求
+        if total_records > DOWNLOAD_API_THRESHOLD and GBIF_USER and GBIF_PWD:
+            if taxon_key is not None and download_species_archive(species_name, taxon_key, archive_path):
+                print(f"  完成: {species_name} - 共 {total_records} 条记录 (DwC-A: {archive_path})")
+                return total_records
+            print(f"  {species_name}: 下载API不可用，改用分页查询")
         
-        # 使用分页获取所有结果
-        while True:
-            retry_count = 0
-            while retry_count < RETRY_COUNT:
-                try:
-                    # 添加延迟避免API限制
-                    if page_count > 0:
-                        time.sleep(REQUEST_DELAY)
-                    
-                    response = requests.get(base_url, params=params)
-                    response.raise_for_status()  # 如有错误则引发异常
-                    
-                    data = response.json()
-                    page_count += 1
-                    
-                    # 第一次请求获取总记录数
-                    if total_records is None:
-                        total_records = data.get('count', 0)
-                        if DEBUG_MODE:
-                            print(f"  {species_name}: 总记录数 {total_records}")
-                    
-                    if 'results' not in data or not data['results']:
-                        if DEBUG_MODE:
-                            print(f"  {species_name}: 无结果，结束查询")
-                        break
-                    
-                    results = data['results']
-                    all_results.extend(results)
-                    record_count += len(results)
-                    
-                    # 显示简洁进度信息
-                    progress_interval = 5 if total_records > 10000 else 2
-                    if page_count % progress_interval == 0 or len(results) < params['limit']:
-                        percentage = round((record_count / total_records * 100), 2) if total_records > 0 else 0
-                        print(f"  {species_name}: 已获取 {record_count}/{total_records} 条记录 ({percentage}%)")
-                    
-                    # 检查是否已获取所有结果或达到上限
-                    if len(results) < params['limit'] or record_count >= MAX_RECORDS_PER_SPECIES or record_count >= total_records:
-                        if DEBUG_MODE:
-                            print(f"  {species_name}: 已达到结束条件，获取完毕")
-                        break
-                    
-                    params['offset'] += params['limit']
-                    break  # 成功获取数据，跳出重试循环
-                    
-                except requests.exceptions.RequestException as e:
-                    retry_count += 1
-                    print(f"  {species_name} 请求出错 ({retry_count}/{RETRY_COUNT}): {e}. {RETRY_DELAY}秒后重试...")
-                    time.sleep(RETRY_DELAY)  # 出错时等待
-            
-            if retry_count == RETRY_COUNT:
-                print(f"  {species_name}: 达到最大重试次数，跳过当前页")
-            
-            # 如果最后一页没有内容或者达到记录上限，退出
-            if 'results' not in data or not data['results'] or len(results) < params['limit'] or record_count >= MAX_RECORDS_PER_SPECIES or record_count >= total_records:
-                break
+        # 其余情况分页下载，超过分页上限时自动切分查询
+        with JsonArrayWriter(species_path) as writer:
+            download_query(species_name, SEARCH_URL, params, writer, total_records)
+            record_count = writer.count
         
-        # 保存结果到JSON文件
-        if all_results:
-            with open(species_path, 'w', encoding='utf-8') as f:
-                json.dump(all_results, f, ensure_ascii=False, indent=2)
-            
+        if record_count:
             print(f"  完成: {species_name} - 共 {record_count} 条记录")
+            if record_count < min(total_records, MAX_RECORDS_PER_SPECIES):
+                print(f"  警告: {species_name} 少于总记录数 {total_records}，缺少 {total_records - record_count} 条记录")
             return record_count
         else:
             print(f"  警告: {species_name} 没有获取到任何记录")
@@ -128,6 +531,78 @@ def download_species(species_name, index=None, total=None):
         print(f"下载 {species_name} 时出错: {e}")
         return 0
 
+def make_batches(probes):
+    """将记录数少于一页的物种分组，每组不超过BATCH_SIZE个物种且总记录数不超过一页，返回 (分组列表, 其余物种列表)"""
+    batches, singles = [], []
+    batch, batch_records = [], 0
+    for species_name, probe in probes:
+        params, taxon_key, total_records = probe or (None, None, None)
+        if taxon_key is None or not total_records or total_records >= params['limit']:
+            singles.append((species_name, probe))
+            continue
+        if len(batch) >= BATCH_SIZE or batch_records + total_records > params['limit']:
+            batches.append(batch)
+            batch, batch_records = [], 0
+        batch.append((species_name, probe))
+        batch_records += total_records
+    if batch:
+        batches.append(batch)
+    
+    # 只有一个物种的分组直接单独下载
+    singles.extend(batch[0] for batch in batches if len(batch) == 1)
+    return [batch for batch in batches if len(batch) > 1], singles
+
+def download_batch(batch):
+    """用一次请求下载多个记录数较少的物种，按物种key拆分后分别写入各自的JSON文件，返回总记录数"""
+    names = ', '.join(species_name for species_name, _ in batch)
+    print(f"批量处理 {len(batch)} 个物种: {names}")
+    
+    # GBIF支持重复的taxonKey参数，返回所有物种记录的并集
+    params = dict(batch[0][1][0])
+    params['taxonKey'] = [taxon_key for _, (_, taxon_key, _) in batch]
+    data = fetch_json(names, SEARCH_URL, params, cache=CACHE_PAGES)
+    
+    # 按记录的物种key归属到各物种
+    grouped = {taxon_key: [] for _, (_, taxon_key, _) in batch}
+    for record in (data or {}).get('results') or []:
+        for key in ('speciesKey', 'taxonKey', 'acceptedTaxonKey'):
+            if record.get(key) in grouped:
+                grouped[record[key]].append(record)
+                break
+    
+    record_total = 0
+    for species_name, probe in batch:
+        _, taxon_key, total_records = probe
+        records = grouped[taxon_key]
+        # 批量请求失败或记录数与查询结果不一致时，该物种改为单独下载
+        if len(records) != total_records:
+            record_total += download_species(species_name, probe=probe)
+            continue
+        
+        species_path, _ = species_paths(species_name)
+        with JsonArrayWriter(species_path) as writer:
+            writer.write(map(trim_record, records) if TRIM_FIELDS else records)
+        print(f"  完成: {species_name} - 共 {writer.count} 条记录")
+        record_total += writer.count
+    return record_total
+
+def run_in_pool(tasks):
+    """将 (函数, 参数...) 任务提交到全局线程池，同时在途的任务数不超过MAX_IN_FLIGHT，按完成顺序返回 (任务, future)"""
+    tasks = iter(tasks)
+    futures = {}
+    
+    def submit_next(n):
+        for task in itertools.islice(tasks, n):
+            futures[POOL.submit(*task)] = task
+    
+    # 完成一个再提交一个
+    submit_next(MAX_IN_FLIGHT)
+    while futures:
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        submit_next(len(done))
+        for future in done:
+            yield futures.pop(future), future
+
 def verify_json_files():
     """检查JSON文件是否有效，移除损坏的文件"""
     print("检查已下载的JSON文件...")
@@ -136,13 +611,13 @@ def verify_json_files():
     if not os.path.exists('occurrences'):
         return 0
         
-    json_files = [f for f in os.listdir('occurrences') if f.endswith('.json')]
-    for json_file in json_files:
-        file_path = os.path.join('occurrences', json_file)
+    with os.scandir('occurrences') as entries:
+        json_files = [(entry.name, entry.path) for entry in entries if entry.name.endswith('.json') and entry.is_file()]
+    for json_file, file_path in json_files:
         try:
             # 尝试加载JSON文件验证其完整性
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            with open(file_path, 'rb') as f:
+                data = orjson.loads(f.read())
                 
             # 检查是否为空数组或无效内容
             if not isinstance(data, list):
@@ -151,7 +626,7 @@ def verify_json_files():
                 # 空数组是有效的，但可能需要重新下载
                 if DEBUG_MODE:
                     print(f"警告: {json_file} 是空数组")
-        except (json.JSONDecodeError, UnicodeDecodeError):
+        except (orjson.JSONDecodeError, UnicodeDecodeError):
             invalid_files.append(file_path)
     
     # 删除损坏的文件
@@ -179,37 +654,55 @@ def main():
     # 记录开始时间
     start_time = datetime.now()
     print(f"开始下载，时间: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"启动 {PARALLEL_DOWNLOADS} 个并行下载进程...")
+    print(f"启动 {PARALLEL_DOWNLOADS} 个并行下载线程，并发请求数在 {MIN_CONCURRENCY}-{MAX_CONCURRENCY} 之间自适应调整...")
     
     # 统计数据
     total_downloaded = 0
     completed_species = 0
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_DOWNLOADS) as executor:
-        # 为每个物种创建任务
-        futures = {
-            executor.submit(download_species, species, i+1, len(species_list)): species
-            for i, species in enumerate(species_list)
-        }
-        
-        # 处理结果
-        for future in concurrent.futures.as_completed(futures):
-            species = futures[future]
-            try:
-                count = future.result()
-                total_downloaded += count
-                completed_species += 1
+    # 已下载的物种直接跳过
+    index_of = {}
+    for i, species in enumerate(species_list):
+        if is_downloaded(species):
+            print(f"跳过物种 {i+1}/{len(species_list)}: {species} (已下载)")
+            completed_species += 1
+        else:
+            index_of.setdefault(species, i + 1)
+    
+    # 先并行查询各物种的记录总数
+    print(f"查询 {len(index_of)} 个物种的记录总数...")
+    probes = dict.fromkeys(index_of)
+    for (_, species), future in run_in_pool((probe_species, species) for species in index_of):
+        try:
+            probes[species] = future.result()
+        except Exception as e:
+            print(f"查询物种 {species} 时出错: {e}")
+    
+    # 记录数少的物种合并为批量请求，其余物种单独下载
+    batches, singles = make_batches(probes.items())
+    tasks = [(download_batch, batch) for batch in batches]
+    tasks += [(download_species, species, index_of[species], len(species_list), probe) for species, probe in singles]
+    if batches:
+        print(f"{sum(len(batch) for batch in batches)} 个物种合并为 {len(batches)} 个批量请求")
+    
+    for task, future in run_in_pool(tasks):
+        names = [species for species, _ in task[1]] if task[0] is download_batch else [task[1]]
+        try:
+            count = future.result()
+            total_downloaded += count
+            completed_before = completed_species
+            completed_species += len(names)
+            
+            # 每完成10个物种显示进度
+            if completed_species // 10 > completed_before // 10:
+                elapsed = datetime.now() - start_time
+                species_per_second = completed_species / elapsed.total_seconds() if elapsed.total_seconds() > 0 else 0
+                estimated_remaining = (len(species_list) - completed_species) / species_per_second if species_per_second > 0 else 0
                 
-                # 每完成10个物种显示进度
-                if completed_species % 10 == 0:
-                    elapsed = datetime.now() - start_time
-                    species_per_second = completed_species / elapsed.total_seconds() if elapsed.total_seconds() > 0 else 0
-                    estimated_remaining = (len(species_list) - completed_species) / species_per_second if species_per_second > 0 else 0
-                    
-                    print(f"进度: {completed_species}/{len(species_list)} 物种 ({round(completed_species/len(species_list)*100, 2)}%)")
-                    print(f"预计剩余时间: {round(estimated_remaining/60, 1)} 分钟")
-            except Exception as e:
-                print(f"处理物种 {species} 时出错: {e}")
+                print(f"进度: {completed_species}/{len(species_list)} 物种 ({round(completed_species/len(species_list)*100, 2)}%)")
+                print(f"预计剩余时间: {round(estimated_remaining/60, 1)} 分钟")
+        except Exception as e:
+            print(f"处理物种 {', '.join(names)} 时出错: {e}")
     
     # 记录下载完成时间
     end_time = datetime.now()
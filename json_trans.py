@@ -2,8 +2,96 @@
 # JSON to Excel 转换工具 - 用于 GBIF 数据
 
 import os
-import json
+import concurrent.futures
+import functools
+import itertools
+import ijson
+import orjson
 import pandas as pd
+import xlsxwriter
+
+# GBIF 字段名 -> 网站显示字段名，可直接重命名的字段
+FIELD_MAPPING = {
+    'scientificName': 'Scientific name',
+    'occurrenceStatus': 'Occurrence status',
+    'basisOfRecord': 'Basis of record',
+    'eventDate': 'Event date',
+    'datasetName': 'Dataset',
+    'typeStatus': 'Type status',
+    'preparations': 'Preparations',
+    'individualCount': 'Individual count',
+    'organismQuantity': 'Organism quantity',
+    'organismQuantityType': 'Organism quantity type',
+    'sampleSizeUnit': 'Sample size unit',
+    'sampleSizeValue': 'Sample size value',
+    'recordNumber': 'Record number',
+    'recordedBy': 'Recorded by',
+    'catalogNumber': 'Catalogue number',
+    'collectionCode': 'Collection code',
+    'institutionCode': 'Institution code',
+    'occurrenceID': 'Occurrence ID',
+    'identifiedBy': 'Identified by',
+    'locality': 'Locality',
+    'waterBody': 'Water body',
+    'stateProvince': 'State province',
+    'county': 'County',
+    'municipality': 'Municipality',
+    'continent': 'Continent',
+    'island': 'Island',
+    'islandGroup': 'Island group',
+    'depth': 'Depth',
+    'elevation': 'Elevation',
+    'habitat': 'Habitat',
+    'fieldNumber': 'Field number',
+    'identificationID': 'Identification ID',
+    'otherCatalogNumbers': 'Other catalogue numbers',
+    'lifeStage': 'Life stage',
+    'sex': 'Sex',
+    'establishmentMeans': 'Establishment means',
+    'degreeOfEstablishment': 'Degree of establishment',
+    'pathway': 'Pathway',
+    'behavior': 'Behavior',
+    'occurrenceRemarks': 'Occurrence remarks',
+    'identificationRemarks': 'Identification remarks',
+    'identificationQualifier': 'Identification qualifier',
+    'higherGeography': 'Higher geography',
+    'higherClassification': 'Higher classification',
+    'identificationVerificationStatus': 'Identification verification status',
+    'geodeticDatum': 'Geodetic datum',
+    'coordinateUncertaintyInMeters': 'Coordinate uncertainty in meters',
+    'coordinatePrecision': 'Coordinate precision',
+    'license': 'License',
+    'rightsHolder': 'Rights holder',
+    'modified': 'Modified',
+    'lastInterpreted': 'Last interpreted',
+    'lastCrawled': 'Last crawled',
+    'lastParsed': 'Last parsed',
+    'taxonKey': 'GBIF taxon ID',
+    'taxonomicStatus': 'Taxonomic status',
+    'dateIdentified': 'Date identified',
+    'taxonRank': 'Rank',
+    'kingdom': 'Kingdom',
+    'phylum': 'Phylum',
+    'class': 'Class',
+    'order': 'Order',
+    'family': 'Family',
+    'genus': 'Genus'
+}
+
+# 派生字段用到的 GBIF 字段
+DERIVED_SOURCE_FIELDS = {
+    'decimalLatitude', 'decimalLongitude', 'country', 'countryCode', 'issues',
+    'publisher', 'publishingOrgKey', 'media', 'species'
+}
+
+# 每批转换的记录数
+CHUNK_SIZE = 10000
+
+# 超过该大小（字节）的 JSON 文件改为流式解析，避免一次性载入内存
+STREAM_THRESHOLD = 64 * 1024 * 1024
+
+# Excel 单个工作表的最大行数（含表头），超出的记录写入后续工作表
+MAX_EXCEL_ROWS = 1048576
 
 def get_gbif_standard_fields():
     """返回GBIF网站标准字段列表，按照网站显示顺序排列"""
@@ -34,152 +122,198 @@ def get_gbif_standard_fields():
         'Parent', 'Parent key', 'HTTP response'
     ]
 
+def standard_field_name(key):
+    """按通用规则将 GBIF 字段名转换为网站显示字段名"""
+    return key.replace('_', ' ').title().replace('Id', 'ID')
+
+@functools.lru_cache(maxsize=None)
+def is_converted_field(key):
+    """判断 GBIF 记录中的字段是否会被转换到 Excel 中（下载时据此裁剪记录）"""
+    return (key in FIELD_MAPPING or key in DERIVED_SOURCE_FIELDS
+            or standard_field_name(key) in get_gbif_standard_fields())
+
+def extract_fields(chunk, species_name, standard_fields):
+    """将一批 GBIF 记录转换为 DataFrame，字段与GBIF网站显示的格式一致"""
+    # 由 pandas 在 C 层一次性读入所有字段，之后的重命名和派生字段均按列处理
+    raw = pd.DataFrame.from_records(chunk)
+    
+    def column(key):
+        if key in raw.columns:
+            return raw[key]
+        return pd.Series(None, index=raw.index, dtype=object)
+    
+    # 简单字段按映射整体重命名，缺失的字段补为空
+    df = raw.rename(columns=FIELD_MAPPING).reindex(columns=list(FIELD_MAPPING.values()), fill_value='')
+    
+    # 坐标格式化
+    latitude, longitude = column('decimalLatitude'), column('decimalLongitude')
+    has_coordinates = latitude.notna() & longitude.notna()
+    df['Coordinates'] = (latitude.astype(str) + ', ' + longitude.astype(str)).where(has_coordinates, '')
+    df['Country or area'] = column('country').fillna(column('countryCode')).fillna('')
+    df['Issues'] = column('issues').map(lambda issues: ','.join(issues) if isinstance(issues, list) else '')
+    df['Publisher'] = column('publisher').fillna(column('publishingOrgKey')).fillna('')
+    df['Media'] = column('media').map(
+        lambda media: ','.join([m.get('identifier', '') for m in media]) if isinstance(media, list) else ''
+    )
+    df['Species'] = column('species').fillna(species_name)
+    
+    # 添加其他可能的字段
+    for key in raw.columns:
+        field_name = standard_field_name(key)
+        if field_name not in df.columns and field_name in standard_fields:
+            df[field_name] = raw[key]
+    
+    return df
+
+def iter_record_chunks(json_path):
+    """按 CHUNK_SIZE 分批读取 JSON 数组中的记录"""
+    if os.path.getsize(json_path) <= STREAM_THRESHOLD:
+        # 一般大小的文件直接用 orjson 整体解码，速度远快于逐条解析
+        with open(json_path, 'rb') as f:
+            data = orjson.loads(f.read())
+        for start in range(0, len(data), CHUNK_SIZE):
+            yield data[start:start + CHUNK_SIZE]
+    else:
+        # 大文件流式解析
+        with open(json_path, 'rb') as f:
+            items = ijson.items(f, 'item', use_float=True)
+            yield from iter(lambda: list(itertools.islice(items, CHUNK_SIZE)), [])
+
+def scan_columns(json_path, species_name, standard_fields):
+    """预先读取一遍记录，返回 (记录数, Excel 列名列表)，使各批数据可按同一组列直接写出"""
+    record_count = 0
+    keys = {}
+    for chunk in iter_record_chunks(json_path):
+        record_count += len(chunk)
+        for record in chunk:
+            keys.update(dict.fromkeys(record))
+    # 用包含所有出现过字段的空记录得到 extract_fields 会生成的列，再按标准字段顺序排列
+    present = extract_fields([dict.fromkeys(keys)], species_name, standard_fields).columns
+    return record_count, [field for field in standard_fields if field in present]
+
+def write_text(worksheet, row, col, value, cell_format=None):
+    """xlsxwriter 不支持的列表/字典值（如 typeStatus、preparations）转为文本写入"""
+    if isinstance(value, list):
+        value = ','.join(str(item) for item in value)
+    return worksheet.write_string(row, col, str(value), cell_format)
+
+def write_excel(frames, columns, xlsx_path):
+    """使用 xlsxwriter 的 constant_memory 模式逐批逐行写出 Excel，不在内存中保留整张工作表，返回工作表数"""
+    # pandas 的 to_excel 按列写入单元格，与 constant_memory 的逐行写入不兼容，因此直接使用 xlsxwriter
+    workbook = xlsxwriter.Workbook(xlsx_path, {
+        'constant_memory': True,
+        'strings_to_urls': False,      # 媒体链接等按普通文本写入
+        'strings_to_formulas': False
+    })
+    header_format = workbook.add_format({'bold': True})
+    
+    # 超过单表行数上限时按顺序拆分到多个工作表，每个工作表都带表头
+    rows_per_sheet = MAX_EXCEL_ROWS - 1
+    worksheet = None
+    sheet_count = 0
+    row = rows_per_sheet
+    for df in frames:
+        # 缺失值写为空单元格
+        values = df.astype(object).where(df.notna(), None)
+        for record in values.itertuples(index=False, name=None):
+            if row >= rows_per_sheet:
+                worksheet = workbook.add_worksheet()
+                worksheet.add_write_handler(list, write_text)
+                worksheet.add_write_handler(dict, write_text)
+                worksheet.write_row(0, 0, columns, header_format)
+                sheet_count += 1
+                row = 0
+            row += 1
+            
+            # write_row 出错时不抛异常而是返回负数，并跳过该行其余单元格，需要检查，否则记录会被静默丢弃
+            error = worksheet.write_row(row, 0, record)
+            if error == -2:
+                # 字符串超过单元格长度上限时被截断，逐个单元格重写该行，保留其余字段
+                errors = [worksheet.write(row, col, value) for col, value in enumerate(record)]
+                error = next((e for e in errors if e not in (0, -2)), 0)
+            if error:
+                raise ValueError(f"写入第 {row} 行失败 (xlsxwriter 返回 {error})")
+    
+    # 文件在 close 时才真正写出，中途出错不会留下不完整的 Excel
+    workbook.close()
+    return sheet_count
+
+def convert_one(json_path, xlsx_path):
+    """将单个 JSON 文件转换为 Excel，成功保存返回 True（在子进程中运行）"""
+    species_name = os.path.basename(json_path).replace('_', ' ').replace('.json', '')
+    xlsx_filename = os.path.basename(xlsx_path)
+    
+    print(f"处理 {species_name}...")
+    
+    # 获取标准字段列表
+    standard_fields = get_gbif_standard_fields()
+    
+    try:
+        # 先确定记录数和存在的标准字段，之后每批转换后直接写出，内存中只保留一批数据
+        record_count, columns = scan_columns(json_path, species_name, standard_fields)
+        
+        if not record_count:
+            print(f"  {species_name} 没有数据记录")
+            return False
+        
+        # 分批解析并转换 JSON 记录，按相同的列顺序写入 Excel
+        frames = (extract_fields(chunk, species_name, standard_fields).reindex(columns=columns)
+                  for chunk in iter_record_chunks(json_path))
+        sheet_count = write_excel(frames, columns, xlsx_path)
+        sheets = f" ({sheet_count} 个工作表)" if sheet_count > 1 else ''
+        print(f"  已保存 {record_count} 条记录到 {xlsx_filename}{sheets}")
+        return True
+        
+    except Exception as e:
+        print(f"  处理 {species_name} 时出错: {e}")
+        return False
+
 def convert_json_to_excel():
     """将所有下载的 JSON 文件转换为 Excel 格式"""
     print("开始将 JSON 数据转换为 Excel...")
     os.makedirs('xlsx_data', exist_ok=True)
     
-    # 获取所有 JSON 文件
-    json_files = [f for f in os.listdir('occurrences') if f.endswith('.json')]
-    print(f"找到 {len(json_files)} 个物种的 JSON 数据")
+    # 获取所有 JSON 文件和已存在的 Excel 文件，各一次目录扫描
+    with os.scandir('occurrences') as entries:
+        json_entries = [entry for entry in entries if entry.name.endswith('.json') and entry.is_file()]
+    print(f"找到 {len(json_entries)} 个物种的 JSON 数据")
     
-    # 获取标准字段列表
-    standard_fields = get_gbif_standard_fields()
+    # 通过GBIF下载API获取的物种保存为 dwca/ 下的 DwC-A 压缩包，不在此转换，需要单独处理
+    if os.path.isdir('dwca'):
+        json_names = {entry.name for entry in json_entries}
+        with os.scandir('dwca') as entries:
+            archived = sorted(entry.name.replace('.zip', '') for entry in entries
+                              if entry.name.endswith('.zip') and entry.name.replace('.zip', '.json') not in json_names)
+        if archived:
+            print(f"警告: {len(archived)} 个物种只有 DwC-A 压缩包，不会生成 Excel: {', '.join(name.replace('_', ' ') for name in archived)}")
+    with os.scandir('xlsx_data') as entries:
+        existing_xlsx = {entry.name for entry in entries if entry.name.endswith('.xlsx')}
+    
+    # 跳过已存在的 Excel 文件
+    pending_entries = []
+    for entry in json_entries:
+        if entry.name.replace('.json', '.xlsx') in existing_xlsx:
+            print(f"跳过 {entry.name.replace('_', ' ').replace('.json', '')} (Excel 已存在)")
+        else:
+            pending_entries.append(entry)
+    
+    # 大文件优先调度，避免最后只剩一个大文件在单个进程中转换
+    pending_entries.sort(key=lambda entry: entry.stat().st_size, reverse=True)
+    json_paths = [entry.path for entry in pending_entries]
+    xlsx_paths = [os.path.join('xlsx_data', entry.name.replace('.json', '.xlsx')) for entry in pending_entries]
     
+    # 各文件相互独立且为CPU密集型任务，主进程只负责调度，解析和写入 Excel 在子进程中并行进行；
+    # 任务只传递文件路径，进程间通信开销很小，因此每次只分派一个文件，避免相邻的大文件被分到同一进程依次执行
     total_processed = 0
-    for json_file in json_files:
-        species_name = json_file.replace('_', ' ').replace('.json', '')
-        xlsx_filename = json_file.replace('.json', '.xlsx')
-        json_path = os.path.join('occurrences', json_file)
-        xlsx_path = os.path.join('xlsx_data', xlsx_filename)
-        
-        # 跳过已存在的 Excel 文件
-        if os.path.exists(xlsx_path):
-            print(f"跳过 {species_name} (Excel 已存在)")
-            continue
-            
-        print(f"处理 {species_name}...")
-        
-        try:
-            # 读取 JSON 文件
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-            if not data:
-                print(f"  {species_name} 没有数据记录")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for saved in executor.map(convert_one, json_paths, xlsx_paths, chunksize=1):
+            if not saved:
                 continue
-                
-            # 提取字段，与GBIF网站显示的格式一致
-            records = []
-            for record in data:
-                # 处理日期格式
-                event_date = record.get('eventDate', '')
-                
-                # 坐标格式化
-                coordinates = ''
-                if record.get('decimalLatitude') is not None and record.get('decimalLongitude') is not None:
-                    coordinates = f"{record.get('decimalLatitude')}, {record.get('decimalLongitude')}"
-                
-                # 构建基础记录
-                extracted = {
-                    'Scientific name': record.get('scientificName', ''),
-                    'Country or area': record.get('country', record.get('countryCode', '')),
-                    'Coordinates': coordinates,
-                    'Event date': event_date,
-                    'Occurrence status': record.get('occurrenceStatus', ''),
-                    'Basis of record': record.get('basisOfRecord', ''),
-                    'Dataset': record.get('datasetName', ''),
-                    'Issues': ','.join(record.get('issues', [])) if isinstance(record.get('issues'), list) else '',
-                    'Type status': record.get('typeStatus', ''),
-                    'Preparations': record.get('preparations', ''),
-                    'Individual count': record.get('individualCount', ''),
-                    'Organism quantity': record.get('organismQuantity', ''),
-                    'Organism quantity type': record.get('organismQuantityType', ''),
-                    'Sample size unit': record.get('sampleSizeUnit', ''),
-                    'Sample size value': record.get('sampleSizeValue', ''),
-                    'Record number': record.get('recordNumber', ''),
-                    'Recorded by': record.get('recordedBy', ''),
-                    'Catalogue number': record.get('catalogNumber', ''),
-                    'Collection code': record.get('collectionCode', ''),
-                    'Institution code': record.get('institutionCode', ''),
-                    'Occurrence ID': record.get('occurrenceID', ''),
-                    'Identified by': record.get('identifiedBy', ''),
-                    'Publisher': record.get('publisher', record.get('publishingOrgKey', '')),
-                    'Locality': record.get('locality', ''),
-                    'Water body': record.get('waterBody', ''),
-                    'State province': record.get('stateProvince', ''),
-                    'County': record.get('county', ''),
-                    'Municipality': record.get('municipality', ''),
-                    'Continent': record.get('continent', ''),
-                    'Island': record.get('island', ''),
-                    'Island group': record.get('islandGroup', ''),
-                    'Depth': record.get('depth', ''),
-                    'Elevation': record.get('elevation', ''),
-                    'Habitat': record.get('habitat', ''),
-                    'Field number': record.get('fieldNumber', ''),
-                    'Identification ID': record.get('identificationID', ''),
-                    'Other catalogue numbers': record.get('otherCatalogNumbers', ''),
-                    'Life stage': record.get('lifeStage', ''),
-                    'Sex': record.get('sex', ''),
-                    'Establishment means': record.get('establishmentMeans', ''),
-                    'Degree of establishment': record.get('degreeOfEstablishment', ''),
-                    'Pathway': record.get('pathway', ''),
-                    'Behavior': record.get('behavior', ''),
-                    'Occurrence remarks': record.get('occurrenceRemarks', ''),
-                    'Identification remarks': record.get('identificationRemarks', ''),
-                    'Identification qualifier': record.get('identificationQualifier', ''),
-                    'Higher geography': record.get('higherGeography', ''),
-                    'Higher classification': record.get('higherClassification', ''),
-                    'Identification verification status': record.get('identificationVerificationStatus', ''),
-                    'Geodetic datum': record.get('geodeticDatum', ''),
-                    'Coordinate uncertainty in meters': record.get('coordinateUncertaintyInMeters', ''),
-                    'Coordinate precision': record.get('coordinatePrecision', ''),
-                    'License': record.get('license', ''),
-                    'Rights holder': record.get('rightsHolder', ''),
-                    'Modified': record.get('modified', ''),
-                    'Last interpreted': record.get('lastInterpreted', ''),
-                    'Last crawled': record.get('lastCrawled', ''),
-                    'Last parsed': record.get('lastParsed', ''),
-                    'Media': ','.join([m.get('identifier', '') for m in record.get('media', [])]) if isinstance(record.get('media'), list) else '',
-                    'GBIF taxon ID': record.get('taxonKey', ''),
-                    'Taxonomic status': record.get('taxonomicStatus', ''),
-                    'Date identified': record.get('dateIdentified', ''),
-                    'Rank': record.get('taxonRank', ''),
-                    'Kingdom': record.get('kingdom', ''),
-                    'Phylum': record.get('phylum', ''),
-                    'Class': record.get('class', ''),
-                    'Order': record.get('order', ''),
-                    'Family': record.get('family', ''),
-                    'Genus': record.get('genus', ''),
-                    'Species': record.get('species', species_name)
-                }
-                
-                # 添加其他可能的字段
-                for key, value in record.items():
-                    field_name = key.replace('_', ' ').title().replace('Id', 'ID')
-                    if field_name not in extracted and field_name in standard_fields:
-                        extracted[field_name] = value
-                
-                records.append(extracted)
-                
-            # 转换为 DataFrame，按照标准字段排序
-            df = pd.DataFrame(records)
-            
-            # 只保留存在的标准字段，按顺序排列
-            existing_fields = [field for field in standard_fields if field in df.columns]
-            df = df[existing_fields]
-            
-            # 保存为Excel
-            df.to_excel(xlsx_path, index=False, engine='openpyxl')
-            print(f"  已保存 {len(records)} 条记录到 {xlsx_filename}")
             total_processed += 1
             
             # 每处理10个文件显示进度
             if total_processed % 10 == 0:
-                print(f"已处理 {total_processed}/{len(json_files)} 个文件 ({round(total_processed/len(json_files)*100, 2)}%)")
-            
-        except Exception as e:
-            print(f"  处理 {species_name} 时出错: {e}")
+                print(f"已处理 {total_processed}/{len(json_entries)} 个文件 ({round(total_processed/len(json_entries)*100, 2)}%)")
     
     print("Excel 转换完成！")
 